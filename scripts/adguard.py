@@ -5,8 +5,12 @@ AGH 规则合并去重工具 | 深度监控全功能版
 特点：保留完整头部信息统计，引入 O(n*L) 级去重算法，支持过滤明细追踪
 """
 
+import itertools
+import operator
+import os
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -25,22 +29,22 @@ TIMEOUT = 30
 def create_retry_session():
     session = requests.Session()
     retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    session.mount("https://", HTTPAdapter(max_retries=retry))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     return session
 
-def fetch_remote_content(url, source_name):
+def fetch_remote_content(session, url):
+    """拉取规则源，返回 (行列表, 耗时, 异常)，日志由调用方统一输出"""
     start = time.time()
     try:
         headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0"}
-        resp = create_retry_session().get(url, headers=headers, timeout=TIMEOUT)
+        resp = session.get(url, headers=headers, timeout=TIMEOUT)
         resp.raise_for_status()
-        content = resp.text
-        lines = content.splitlines()
-        print(f"  [✓] 同步完成: {source_name:<10} | 耗时: {time.time()-start:>5.2f}s | 原始规模: {len(lines):>6} 行")
-        return content, len(lines)
+        lines = resp.content.decode('utf-8', 'replace').splitlines()
+        return lines, time.time() - start, None
     except Exception as e:
-        print(f"  [✗] 同步失败: {source_name:<10} | 错误: {type(e).__name__}")
-        return "", 0
+        return [], time.time() - start, e
 
 def apply_containment_dedup(rules, rule_type="规则"):
     if not rules:
@@ -49,28 +53,34 @@ def apply_containment_dedup(rules, rule_type="规则"):
     start_time = time.time()
     processed = []
     for r in rules:
-        domain = r.split('$')[0].replace('||', '').replace('@@', '').replace('^', '').lower()
+        domain = r
+        i = domain.find('$')
+        if i >= 0:
+            domain = domain[:i]
+        domain = domain.removeprefix('@@').removeprefix('||').removesuffix('^').lower()
         if domain:
-            processed.append((domain, r))
+            processed.append((domain.count('.'), domain, r))
     
     # 核心：按域名层级排序
-    processed.sort(key=lambda x: x[0].count('.'))
+    processed.sort(key=operator.itemgetter(0))
     
     final_rules = []
     seen_domains = set()
     removed_details = [] 
     
-    for dom, original in processed:
-        is_subdomain = False
-        parts = dom.split('.')
-        for i in range(len(parts) - 1, 0, -1):
-            parent = ".".join(parts[i:])
-            if parent in seen_domains:
-                is_subdomain = True
-                removed_details.append(f"[{rule_type}] {original:<45} # 父域覆盖: {parent}")
+    for _, dom, original in processed:
+        # 从顶级域开始逐级切片父域，不做 split/join
+        parent = None
+        i = dom.rfind('.')
+        while i >= 0:
+            if dom[i + 1:] in seen_domains:
+                parent = dom[i + 1:]
                 break
+            i = dom.rfind('.', 0, i)
         
-        if not is_subdomain:
+        if parent is not None:
+            removed_details.append(f"[{rule_type}] {original:<45} # 父域覆盖: {parent}")
+        else:
             final_rules.append(original)
             seen_domains.add(dom)
     
@@ -82,44 +92,66 @@ def main():
     source_stats_list = []
     total_raw_line = 0
     total_skip = 0
-    all_raw_rules = []
+    total_valid = 0
+    unique_rules = []
+    seen = set()
+    session = create_retry_session()
 
     print("="*80 + "\n📦 开始处理【所有AGH规则源】\n" + "="*80)
 
-    # 1. 拉取与初步统计
-    for url, name in zip(AGH_RULE_URLS, AGH_RULE_NAMES):
-        content, raw_line_count = fetch_remote_content(url, name)
+    # 1. 并发拉取，再按源顺序初步统计并全局基础去重
+    with ThreadPoolExecutor(max_workers=len(AGH_RULE_URLS)) as ex:
+        results = list(ex.map(lambda url: fetch_remote_content(session, url), AGH_RULE_URLS))
+
+    for name, (lines, elapsed, error) in zip(AGH_RULE_NAMES, results):
+        raw_line_count = len(lines)
+        if error is None:
+            print(f"  [✓] 同步完成: {name:<10} | 耗时: {elapsed:>5.2f}s | 原始规模: {raw_line_count:>6} 行")
+        else:
+            print(f"  [✗] 同步失败: {name:<10} | 错误: {type(error).__name__}")
         total_raw_line += raw_line_count
         
-        valid = []
+        valid = 0
         skip_count = 0
-        for line in content.splitlines():
+        black = white = 0
+        for line in lines:
             line = line.strip()
             if not line or line.startswith(('!', '#')):
                 skip_count += 1
                 continue
-            valid.append(line)
+            valid += 1
+            if line not in seen:
+                seen.add(line)
+                unique_rules.append(line)
+            # 统计黑白名单
+            c = line[:2]
+            if c == "||":
+                black += 1
+            elif c == "@@":
+                white += 1
         
         total_skip += skip_count
-        # 统计黑白名单
-        black = sum(1 for r in valid if r.startswith("||"))
-        white = sum(1 for r in valid if r.startswith("@@"))
+        total_valid += valid
         
         stats = {
             "name": name, "raw_line": raw_line_count, "skip": skip_count,
-            "total_rule": len(valid), "black": black, "white": white, "other": len(valid)-black-white
+            "total_rule": valid, "black": black, "white": white, "other": valid-black-white
         }
         source_stats_list.append(stats)
-        all_raw_rules.extend(valid)
 
-    # 2. 全局基础去重
-    unique_rules = list(dict.fromkeys(all_raw_rules))
-    cross_dedup = len(all_raw_rules) - len(unique_rules)
+    # 2. 跨源重复统计
+    cross_dedup = total_valid - len(unique_rules)
 
     # 3. 逻辑分类
-    white_list = [r for r in unique_rules if r.startswith("@@")]
-    black_list = [r for r in unique_rules if r.startswith("||")]
-    other_list = [r for r in unique_rules if not (r.startswith("@@") or r.startswith("||"))]
+    white_list, black_list, other_list = [], [], []
+    for r in unique_rules:
+        c = r[:2]
+        if c == "@@":
+            white_list.append(r)
+        elif c == "||":
+            black_list.append(r)
+        else:
+            other_list.append(r)
 
     # 4. 高级算法包含去重
     print(f"\n[阶段 2] 正在分析域名包含关系...")
@@ -154,12 +186,16 @@ def main():
     ]
 
     # 6. 持久化存储
-    with open(AGH_OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(header + final_rules))
-
-    with open(REMOVED_LOG_FILE, 'w', encoding='utf-8') as f:
+    tmp_file = AGH_OUTPUT_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write('\n'.join(header))
+        f.write('\n')
+        f.writelines(r + '\n' for r in final_rules)
+    os.replace(tmp_file, AGH_OUTPUT_FILE)
+
+    with open(REMOVED_LOG_FILE, 'w', encoding='utf-8', buffering=1 << 20) as f:
         f.write(f"# AGH 过滤明细日志 - {beijing_time}\n" + "="*80 + "\n")
-        f.write('\n'.join(white_removed + black_removed))
+        f.writelines(line + '\n' for line in itertools.chain(white_removed, black_removed))
 
     # 7. 控制台最终大报告
     print("\n" + "="*80)
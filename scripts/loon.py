@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import requests
-import ipaddress
-import re
+import socket
+import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -25,57 +27,82 @@ OUTPUT_FILE = "Loon.lsr"
 AUDIT_LOG_FILE = "Loon.log"
 # ==========================================
 
+_DOMAIN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789.-")
+
 def get_beijing_time():
     return (datetime.utcnow() + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
 
 def create_session():
     session = requests.Session()
     retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
 
+def fetch_lines(session, src):
+    """拉取单个规则源，返回 (行列表, 异常)"""
+    try:
+        resp = session.get(src['url'], timeout=30)
+        resp.raise_for_status()
+        return resp.text.splitlines(), None
+    except Exception as e:
+        return None, e
+
+def _parse_cidr(cidr):
+    """将 a.b.c.d/p 解析为 (网络地址整数, 前缀长度)，格式非法时抛出 ValueError
+    
+    仅接受前缀长度写法，a.b.c.d/255.255.0.0 这类掩码写法视为非法
+    """
+    addr, sep, plen = cidr.partition('/')
+    octets = addr.split('.')
+    if len(octets) != 4 or not all(o.isdigit() and str(int(o)) == o and int(o) <= 255 for o in octets):
+        raise ValueError(f"非法IPv4地址: {cidr}")
+    if sep and not (plen.isdigit() and int(plen) <= 32):
+        raise ValueError(f"非法前缀长度: {cidr}")
+    prefix = int(plen) if sep else 32
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    return struct.unpack('>I', socket.inet_aton(addr))[0] & mask, prefix
+
 def parse_rule(line):
-    """解析规则，仅识别 DOMAIN, DOMAIN-SUFFIX, IP-CIDR"""
-    line = line.strip()
-    
-    # 跳过空行和注释
-    if not line or line.startswith('#') or line.startswith('//') or line.startswith('!'):
-        return None, None, False, False
+    """解析规则，仅识别 DOMAIN, DOMAIN-SUFFIX, IP-CIDR
     
+    line 须为已 strip 的非空、非注释行
+    返回 (rtype, rval, ok, is_leading_dot, has_no_resolve, net)
+    net 仅对 IP-CIDR 有效，为 _parse_cidr 的结果，其余为 None
+    """
     # 检查前导点（视为无效，仅统计）
     if line.startswith('.'):
-        return None, None, False, True  # True 表示是前导点格式
+        return None, None, False, True, False, None  # True 表示是前导点格式
     
     parts = [p.strip() for p in line.split(',')]
     if len(parts) < 2:
-        return None, None, False, False
+        return None, None, False, False, False, None
     
     rtype = parts[0].upper()
-    rval = parts[1].lower().strip()
+    rval = parts[1].lower()
     
     if rtype not in ('DOMAIN', 'DOMAIN-SUFFIX', 'IP-CIDR'):
-        return None, None, False, False
+        return None, None, False, False, False, None
     
     if not rval:
-        return None, None, False, False
+        return None, None, False, False, False, None
     
     # IP-CIDR 验证
     if rtype == 'IP-CIDR':
         try:
-            ipaddress.IPv4Network(rval, strict=False)
+            net = _parse_cidr(rval)
         except ValueError:
-            return None, None, False, False
-        # 检查是否已有 no-resolve
-        has_no_resolve = len(parts) >= 3 and 'no-resolve' in [p.strip().lower() for p in parts[2:]]
-        return rtype, rval, True, has_no_resolve
+            return None, None, False, False, False, None
+        # 检查是否已有 no-resolve（类型与地址均已校验，只可能出现在后续参数中）
+        has_no_resolve = 'no-resolve' in line.lower()
+        return rtype, rval, True, False, has_no_resolve, net
     
     # 域名验证
-    if not re.match(r'^[a-z0-9\-\.]+$', rval) or rval.startswith('.') or rval.endswith('.') or '..' in rval:
-        return None, None, False, False
+    if not _DOMAIN_CHARS.issuperset(rval) or rval.startswith('.') or rval.endswith('.') or '..' in rval:
+        return None, None, False, False, False, None
     
-    return rtype, rval, True, False
+    return rtype, rval, True, False, False, None
 
 def normalize(rtype, rval, has_no_resolve=False):
     """标准化规则"""
@@ -94,112 +121,121 @@ class DomainTrie:
     def add(self, suffix):
         node = self.root
         for part in reversed(suffix.split('.')):
-            if part not in node:
-                node[part] = {}
-            node = node[part]
-        node['#'] = True
+            child = node.get(part)
+            if child is None:
+                child = node[part] = {}
+            node = child
+        node['#'] = suffix
     
     def is_covered(self, domain):
         """检查domain是否被某个DOMAIN-SUFFIX覆盖"""
         node = self.root
-        matched = []
         for part in reversed(domain.split('.')):
-            if '#' in node and matched:
-                return True, '.'.join(reversed(matched))
-            if part not in node:
+            parent = node.get('#')
+            if parent is not None:
+                return True, parent
+            node = node.get(part)
+            if node is None:
                 return False, None
-            node = node[part]
-            matched.append(part)
-        return '#' in node, '.'.join(reversed(matched)) if matched else None
+        parent = node.get('#')
+        return parent is not None, parent
 
 class IPCidrManager:
-    """IP-CIDR管理器"""
+    """IP-CIDR管理器（按地址位逐位构建的二叉Trie）"""
     
     def __init__(self):
-        self.nets = []
+        self.root = {}
     
-    def add(self, cidr):
-        network = ipaddress.IPv4Network(cidr, strict=False)
-        
-        # 检查是否被已有网段覆盖
-        for existing_net, existing_str in self.nets:
-            if existing_net.supernet_of(network):
-                return True, existing_str
-        
-        # 移除被新网段覆盖的
-        self.nets = [(n, s) for n, s in self.nets if not network.supernet_of(n)]
-        self.nets.append((network, cidr))
+    def add(self, addr, prefix, cidr):
+        """需按前缀长度升序（大网段优先）调用，先收录者覆盖后来者"""
+        node = self.root
+        for i in range(prefix):
+            term = node.get('#')
+            if term is not None:
+                return True, term
+            bit = (addr >> (31 - i)) & 1
+            child = node.get(bit)
+            if child is None:
+                child = node[bit] = {}
+            node = child
+        term = node.get('#')
+        if term is not None:
+            return True, term
+        node['#'] = cidr
         return False, None
 
 def main():
-    print(f"[{get_beijing_time()}] 开始获取规则...")
+    t0 = get_beijing_time()
+    print(f"[{t0}] 开始获取规则...")
     session = create_session()
-    all_rules = []  # (norm, rtype, rval, source, orig, has_no_resolve)
+    all_rules = []  # (norm, rtype, rval, source, orig, has_no_resolve, net)
     source_stats = []
     
-    # 获取规则
-    for src in RULE_SOURCES:
-        try:
-            resp = session.get(src['url'], timeout=30)
-            resp.raise_for_status()
-            lines = resp.text.splitlines()
-            
-            valid = 0
-            leading_dot = 0
-            
-            for line in lines:
-                rtype, rval, ok, is_leading_dot = parse_rule(line)
-                
-                if is_leading_dot:
-                    leading_dot += 1
-                    continue
+    # 并发获取规则
+    with ThreadPoolExecutor(max_workers=len(RULE_SOURCES)) as ex:
+        results = list(ex.map(lambda src: fetch_lines(session, src), RULE_SOURCES))
+    
+    for src, (lines, error) in zip(RULE_SOURCES, results):
+        if error is None:
+            try:
+                valid = 0
+                leading_dot = 0
                 
-                if ok:
-                    has_no_resolve = False
-                    if rtype == 'IP-CIDR':
-                        # 重新解析检查 no-resolve
-                        parts = [p.strip() for p in line.split(',')]
-                        has_no_resolve = len(parts) >= 3 and 'no-resolve' in [p.strip().lower() for p in parts[2:]]
+                for line in lines:
+                    line = line.strip()
+                    # 跳过空行和注释
+                    if not line or line.startswith(('#', '//', '!')):
+                        continue
                     
-                    norm = normalize(rtype, rval, has_no_resolve)
-                    all_rules.append((norm, rtype, rval, src['name'], line.strip(), has_no_resolve))
-                    valid += 1
-            
-            source_stats.append({
-                'name': src['name'],
-                'total': len(lines),
-                'valid': valid,
-                'leading_dot': leading_dot
-            })
-            print(f"[{get_beijing_time()}] {src['name']}: 有效 {valid}, 前导点 {leading_dot}, 总行 {len(lines)}")
-            
-        except Exception as e:
-            print(f"[{get_beijing_time()}] {src['name']} 获取失败: {e}")
+                    rtype, rval, ok, is_leading_dot, has_no_resolve, net = parse_rule(line)
+                    
+                    if is_leading_dot:
+                        leading_dot += 1
+                        continue
+                    
+                    if ok:
+                        norm = normalize(rtype, rval, has_no_resolve)
+                        all_rules.append((norm, rtype, rval, src['name'], line, has_no_resolve, net))
+                        valid += 1
+            except Exception as e:
+                error = e
+        
+        if error is not None:
+            print(f"[{t0}] {src['name']} 获取失败: {error}")
             source_stats.append({
                 'name': src['name'],
                 'total': 0,
                 'valid': 0,
                 'leading_dot': 0,
-                'error': str(e)
+                'error': str(error)
             })
+            continue
+        
+        source_stats.append({
+            'name': src['name'],
+            'total': len(lines),
+            'valid': valid,
+            'leading_dot': leading_dot
+        })
+        print(f"[{t0}] {src['name']}: 有效 {valid}, 前导点 {leading_dot}, 总行 {len(lines)}")
     
     if not all_rules:
         print("没有有效规则")
         return
     
-    print(f"[{get_beijing_time()}] 开始去重，共 {len(all_rules)} 条...")
+    print(f"[{t0}] 开始去重，共 {len(all_rules)} 条...")
     
     # 第一步：完全相同去重
     seen = {}
     unique = []
     exact_dup = 0
     
-    for norm, rtype, rval, source, orig, has_no_resolve in all_rules:
+    for norm, rtype, rval, source, orig, has_no_resolve, net in all_rules:
         if norm in seen:
             exact_dup += 1
         else:
             seen[norm] = source
-            unique.append((norm, rtype, rval, source, orig))
+            unique.append((norm, rtype, rval, source, orig, net))
     
     # 第二步：包含去重
     trie = DomainTrie()
@@ -212,7 +248,7 @@ def main():
     ip_covered = 0
     
     # 先处理 DOMAIN-SUFFIX（按长度排序，父域优先）
-    suffixes = [(n, r, v, s, o) for n, r, v, s, o in unique if r == 'DOMAIN-SUFFIX']
+    suffixes = [(n, r, v, s, o) for n, r, v, s, o, _ in unique if r == 'DOMAIN-SUFFIX']
     suffixes.sort(key=lambda x: len(x[2]))
     
     for norm, rtype, rval, source, orig in suffixes:
@@ -225,7 +261,7 @@ def main():
             final_suffixes.append(norm)
     
     # 处理 DOMAIN
-    domains = [(n, r, v, s, o) for n, r, v, s, o in unique if r == 'DOMAIN']
+    domains = [(n, r, v, s, o) for n, r, v, s, o, _ in unique if r == 'DOMAIN']
     for norm, rtype, rval, source, orig in domains:
         covered, by = trie.is_covered(rval)
         if covered:
@@ -235,11 +271,11 @@ def main():
             final_domains.append(norm)
     
     # 处理 IP-CIDR（大网段优先）
-    ips = [(n, r, v, s, o) for n, r, v, s, o in unique if r == 'IP-CIDR']
-    ips.sort(key=lambda x: int(x[2].split('/')[1]), reverse=True)
+    ips = [(net, n, v, o) for n, r, v, s, o, net in unique if r == 'IP-CIDR']
+    ips.sort(key=lambda x: x[0][1])
     
-    for norm, rtype, rval, source, orig in ips:
-        covered, by = ip_mgr.add(rval)
+    for (addr, prefix), norm, rval, orig in ips:
+        covered, by = ip_mgr.add(addr, prefix, rval)
         if covered:
             ip_covered += 1
             cover_logs.append(f"[包含去重] {orig:<50} # 溯源: IP-CIDR,{by}")
@@ -257,10 +293,11 @@ def main():
     }
     
     # 生成文件头（新风格）
+    t_end = get_beijing_time()
     header_lines = [
         "# ==========================================================",
         "# 合并规则文件",
-        f"# 生成时间: {get_beijing_time()}",
+        f"# 生成时间: {t_end}",
         f"# 总计保留: {len(final_rules)} 条规则",
         f"# 类型分布: DOMAIN: {type_counts['DOMAIN']} | DOMAIN-SUFFIX: {type_counts['DOMAIN-SUFFIX']} | IP-CIDR: {type_counts['IP-CIDR']}",
         f"# 压缩分析: 完全相同去重 {exact_dup} | 域名包含去重 {domain_covered} | IP网段包含去重 {ip_covered}",
@@ -279,12 +316,15 @@ def main():
     ])
     
     # 写规则文件
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(header_lines) + '\n'.join(final_rules))
+    tmp_file = OUTPUT_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write('\n'.join(header_lines))
+        f.writelines(r + '\n' for r in final_rules)
+    os.replace(tmp_file, OUTPUT_FILE)
     
     # 写审计日志
     log_lines = [
-        f"# 规则合并审计日志 - {get_beijing_time()}",
+        f"# 规则合并审计日志 - {t_end}",
         "# ----------------------------------------------------------",
         f"# 最终规则总数: {len(final_rules)}",
         f"# 逻辑精简总数: {domain_covered + ip_covered}",
@@ -292,16 +332,15 @@ def main():
         ""
     ]
     
-    if cover_logs:
-        log_lines.extend(cover_logs)
-    else:
-        log_lines.append("# 无包含去重记录")
-    
-    with open(AUDIT_LOG_FILE, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(log_lines))
+    with open(AUDIT_LOG_FILE, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write('\n'.join(log_lines) + '\n')
+        if cover_logs:
+            f.writelines(line + '\n' for line in cover_logs)
+        else:
+            f.write("# 无包含去重记录\n")
     
     # 输出摘要
-    print(f"\n[{get_beijing_time()}] 处理完成!")
+    print(f"\n[{t_end}] 处理完成!")
     print(f"  原始规则: {len(all_rules)}")
     print(f"  完全相同去重: {exact_dup}")
     print(f"  域名包含去重: {domain_covered}")